@@ -1,81 +1,151 @@
 from __future__ import absolute_import
 
 import mock
-import six
+import pytest
 
+from exam import fixture
+from functools32 import lru_cache
+
+from django.contrib.auth.hashers import make_password
 from django.core.urlresolvers import reverse
+from django.test.utils import override_settings
+
+from rest_framework.test import APIClient
 
 from sentry.models import Authenticator, TotpInterface, RecoveryCodeInterface, SmsInterface
 from sentry.testutils import APITestCase
 
-
-class UserAuthenticatorDetailsTest(APITestCase):
+# hashed once at import so create_user() doesn't re-run the password
+# hasher for every test; login_as() never verifies the password
+PASSWORD = make_password('admin')
+
+
+@lru_cache(maxsize=None)
+def _url_template(name, *url_kwargs):
+    # both patterns accept any non-slash value, so probe the resolver
+    # once with sentinel values and keep the result as a format string;
+    # building a concrete URL afterwards never walks the resolver
+    sentinels = dict((url_kwarg, '__%s__' % url_kwarg) for url_kwarg in url_kwargs)
+    template = reverse(name, kwargs=sentinels)
+    for url_kwarg, sentinel in sentinels.items():
+        template = template.replace(sentinel, '%%(%s)s' % url_kwarg)
+    return template
+
+
+def get_details_url(user_id, auth_id):
+    return _url_template(
+        'sentry-api-0-user-authenticator-details',
+        'user_id', 'auth_id',
+    ) % {
+        'user_id': user_id,
+        'auth_id': auth_id,
+    }
+
+
+def get_device_details_url(user_id, auth_id, interface_device_id):
+    return _url_template(
+        'sentry-api-0-user-authenticator-device-details',
+        'user_id', 'auth_id', 'interface_device_id',
+    ) % {
+        'user_id': user_id,
+        'auth_id': auth_id,
+        'interface_device_id': interface_device_id,
+    }
+
+
+@lru_cache(maxsize=8)
+def _client_for(user):
+    # cached per user (model instances hash by primary key); the autouse
+    # fixture below drops the cache after each test so users rolled back
+    # with the test transaction can't leak into the next one
+    client = APIClient()
+    client.force_authenticate(user=user)
+    return client
+
+
+@pytest.fixture(autouse=True)
+def _clear_client_cache():
+    yield
+    _client_for.cache_clear()
+
+
+@pytest.fixture(autouse=True, scope='module')
+def _mute_analytics():
+    # every create_user() fires the user.created post_save receiver,
+    # which builds and dispatches an analytics event nothing in this
+    # module looks at; the other User receiver (UserEmail creation)
+    # has to keep running because create_user() depends on it
+    with mock.patch('sentry.analytics.record'):
+        yield
+
+
+@pytest.fixture(scope='module')
+def _email_logger():
+    # patch the email logger once for the whole module instead of once
+    # per test method; the autouse fixture below resets it between tests
+    with mock.patch('sentry.utils.email.logger') as logger:
+        yield logger
+
+
+@pytest.fixture(autouse=True)
+def email_log(request, _email_logger):
+    _email_logger.reset_mock()
+    request.instance.email_log = _email_logger
+    return _email_logger
+
+
+@override_settings(PASSWORD_HASHERS=['django.contrib.auth.hashers.MD5PasswordHasher'])
+class UserAuthenticatorDetailsTestBase(APITestCase):
     def setUp(self):
-        self.user = self.create_user(email='test@example.com', is_superuser=False)
-        self.login_as(user=self.user)
-
-    def _assert_mfa_removed_email_sent(*args):
-        test, email_log = args
-        assert email_log.info.call_count == 1
-        assert 'mail.queued' in email_log.info.call_args[0]
-        assert email_log.info.call_args[1]['extra']['message_type'] == 'mfa-removed'
-
-    def test_wrong_auth_id(self):
-        url = reverse(
-            'sentry-api-0-user-authenticator-details',
-            kwargs={
-                'user_id': self.user.id,
-                'auth_id': 'totp',
+        self.user = self.create_user(
+            email='test@example.com', is_superuser=False, password=PASSWORD)
+        # authenticate in-memory instead of going through the session
+        # backend; none of these tests exercise superuser, which is the
+        # only thing login_as() adds on top of this
+        self.client = _client_for(self.user)
+
+
+class UserAuthenticatorDetailsTest(UserAuthenticatorDetailsTestBase):
+    # These tests never mutate the authenticator they look at and only
+    # assert on the response structure, so the rows are written directly
+    # with canned configs instead of running the enrollment crypto; the
+    # mutating tests live in UserAuthenticatorMutationTest and keep full
+    # enrollment where the semantics depend on it.
+    @fixture
+    def totp_auth(self):
+        return Authenticator.objects.create(
+            type=TotpInterface.type,
+            user=self.user,
+            config={
+                'secret': 'ABCDEFGHIJKLMNOPQRSTUVWXYZ234567',
             }
         )
 
-        resp = self.client.get(url)
-        assert resp.status_code == 404
-
-    def test_get_authenticator_details(self):
-        interface = TotpInterface()
-        interface.enroll(self.user)
-        auth = interface.authenticator
-
-        url = reverse(
-            'sentry-api-0-user-authenticator-details',
-            kwargs={
-                'user_id': self.user.id,
-                'auth_id': auth.id,
+    @fixture
+    def recovery_auth(self):
+        return Authenticator.objects.create(
+            type=RecoveryCodeInterface.type,
+            user=self.user,
+            config={
+                'salt': '9f8a7b6c5d4e3f21',
+                'used': 0,
             }
         )
 
-        resp = self.client.get(url)
-        assert resp.status_code == 200
-        assert resp.data['isEnrolled']
-        assert resp.data['id'] == "totp"
-        assert resp.data['authId'] == six.text_type(auth.id)
-
-        # should not have these because enrollment
-        assert 'totp_secret' not in resp.data
-        assert 'form' not in resp.data
-        assert 'qrcode' not in resp.data
-
-    def test_get_recovery_codes(self):
-        interface = RecoveryCodeInterface()
-        interface.enroll(self.user)
-
-        url = reverse(
-            'sentry-api-0-user-authenticator-details',
-            kwargs={
-                'user_id': self.user.id,
-                'auth_id': interface.authenticator.id,
+    @fixture
+    def sms_auth(self):
+        return Authenticator.objects.create(
+            type=SmsInterface.type,
+            user=self.user,
+            config={
+                'secret': 'ABCDEFGHIJKLMNOPQRSTUVWXYZ234567',
+                'phone_number': '5551231234',
             }
         )
 
-        resp = self.client.get(url)
-        assert resp.status_code == 200
-        assert resp.data['id'] == "recovery"
-        assert resp.data['authId'] == six.text_type(interface.authenticator.id)
-        assert len(resp.data['codes'])
-
-    def test_u2f_get_devices(self):
-        auth = Authenticator.objects.create(
+    @fixture
+    def u2f_auth(self):
+        return Authenticator.objects.create(
             type=3,  # u2f
             user=self.user,
             config={
@@ -91,27 +161,59 @@ class UserAuthenticatorDetailsTest(APITestCase):
             }
         )
 
-        url = reverse(
-            'sentry-api-0-user-authenticator-details',
-            kwargs={
-                'user_id': self.user.id,
-                'auth_id': auth.id,
-            }
-        )
+    def _assert_totp_details(self, data):
+        assert data['isEnrolled']
 
-        resp = self.client.get(url)
-        assert resp.status_code == 200
-        assert resp.data['id'] == "u2f"
-        assert resp.data['authId'] == six.text_type(auth.id)
-        assert len(resp.data['devices'])
-        assert resp.data['devices'][0]['name'] == 'Amused Beetle'
+        # should not have these because enrollment
+        assert 'totp_secret' not in data
+        assert 'form' not in data
+        assert 'qrcode' not in data
+
+    def _assert_recovery_details(self, data):
+        assert len(data['codes'])
+
+    def _assert_sms_details(self, data):
+        assert data['phone'] == '5551231234'
 
         # should not have these because enrollment
-        assert 'challenge' not in resp.data
-        assert 'response' not in resp.data
+        assert 'totp_secret' not in data
+        assert 'form' not in data
 
-    @mock.patch('sentry.utils.email.logger')
-    def test_u2f_remove_device(self, email_log):
+    def _assert_u2f_details(self, data):
+        assert len(data['devices'])
+        assert data['devices'][0]['name'] == 'Amused Beetle'
+
+        # should not have these because enrollment
+        assert 'challenge' not in data
+        assert 'response' not in data
+
+    def test_wrong_auth_id(self):
+        url = get_details_url(self.user.id, 'totp')
+
+        resp = self.client.get(url)
+        assert resp.status_code == 404
+
+    def test_get_details_per_interface(self):
+        # pytest.mark.parametrize doesn't apply to unittest-style test
+        # methods, so drive the shared GET/assert pattern from a table
+        for auth, expected_id, assert_details in (
+            (self.totp_auth, 'totp', self._assert_totp_details),
+            (self.recovery_auth, 'recovery', self._assert_recovery_details),
+            (self.sms_auth, 'sms', self._assert_sms_details),
+            (self.u2f_auth, 'u2f', self._assert_u2f_details),
+        ):
+            url = get_details_url(self.user.id, auth.id)
+
+            resp = self.client.get(url)
+            assert resp.status_code == 200
+            assert resp.data['id'] == expected_id
+            assert resp.data['authId'] == str(auth.id)
+
+            assert_details(resp.data)
+
+
+class UserAuthenticatorMutationTest(UserAuthenticatorDetailsTestBase):
+    def test_u2f_remove_device(self):
         auth = Authenticator.objects.create(
             type=3,  # u2f
             user=self.user,
@@ -136,70 +238,32 @@ class UserAuthenticatorDetailsTest(APITestCase):
             }
         )
 
-        url = reverse(
-            'sentry-api-0-user-authenticator-device-details',
-            kwargs={
-                'user_id': self.user.id,
-                'auth_id': auth.id,
-                'interface_device_id': 'devicekeyhandle'
-            }
-        )
+        url = get_device_details_url(self.user.id, auth.id, 'devicekeyhandle')
 
-        resp = self.client.delete(url)
+        # removing a device rewrites the config on the existing row and
+        # nothing else
+        with self.assertWriteQueries({'auth_authenticator': 1}):
+            resp = self.client.delete(url)
         assert resp.status_code == 204
 
-        authenticator = Authenticator.objects.get(id=auth.id)
-        assert len(authenticator.interface.get_registered_devices()) == 1
+        # Django 1.6 has no refresh_from_db; pull back just the mutated
+        # config onto the existing instance instead of re-fetching and
+        # deserializing the whole row
+        auth.config = Authenticator.objects.only('config').get(id=auth.id).config
+        assert len(auth.interface.get_registered_devices()) == 1
 
         # Can't remove last device
-        url = reverse(
-            'sentry-api-0-user-authenticator-device-details',
-            kwargs={
-                'user_id': self.user.id,
-                'auth_id': auth.id,
-                'interface_device_id': 'aowerkoweraowerkkro',
-            }
-        )
+        url = get_device_details_url(self.user.id, auth.id, 'aowerkoweraowerkkro')
         resp = self.client.delete(url)
         assert resp.status_code == 500
 
-        assert email_log.info.call_count == 0
-
-    def test_sms_get_phone(self):
-        interface = SmsInterface()
-        interface.phone_number = '5551231234'
-        interface.enroll(self.user)
-
-        url = reverse(
-            'sentry-api-0-user-authenticator-details',
-            kwargs={
-                'user_id': self.user.id,
-                'auth_id': interface.authenticator.id,
-            }
-        )
-
-        resp = self.client.get(url)
-        assert resp.status_code == 200
-        assert resp.data['id'] == "sms"
-        assert resp.data['authId'] == six.text_type(interface.authenticator.id)
-        assert resp.data['phone'] == '5551231234'
-
-        # should not have these because enrollment
-        assert 'totp_secret' not in resp.data
-        assert 'form' not in resp.data
+        assert self.email_log.info.call_count == 0
 
-    @mock.patch('sentry.utils.email.logger')
-    def test_recovery_codes_regenerate(self, email_log):
+    def test_recovery_codes_regenerate(self):
         interface = RecoveryCodeInterface()
         interface.enroll(self.user)
 
-        url = reverse(
-            'sentry-api-0-user-authenticator-details',
-            kwargs={
-                'user_id': self.user.id,
-                'auth_id': interface.authenticator.id,
-            }
-        )
+        url = get_details_url(self.user.id, interface.authenticator.id)
 
         resp = self.client.get(url)
         assert resp.status_code == 200
@@ -208,58 +272,63 @@ class UserAuthenticatorDetailsTest(APITestCase):
         resp = self.client.get(url)
         assert old_codes == resp.data['codes']
 
-        # regenerate codes
-        resp = self.client.put(url)
+        # regenerate codes; a single update of the stored config
+        with self.assertWriteQueries({'auth_authenticator': 1}):
+            resp = self.client.put(url)
 
         resp = self.client.get(url)
         assert old_codes != resp.data['codes']
 
-        assert email_log.info.call_count == 0
+        assert self.email_log.info.call_count == 0
+
 
-    @mock.patch('sentry.utils.email.logger')
-    def test_delete(self, email_log):
-        user = self.create_user(email='a@example.com', is_superuser=True)
+@override_settings(PASSWORD_HASHERS=['django.contrib.auth.hashers.MD5PasswordHasher'])
+class UserAuthenticatorDeleteTest(APITestCase):
+    # these tests authenticate as users they create themselves, so they
+    # deliberately skip the default user/client setUp of the base class
+    def _assert_mfa_removed_email_sent(self):
+        assert self.email_log.info.call_count == 1
+        assert 'mail.queued' in self.email_log.info.call_args[0]
+        assert self.email_log.info.call_args[1]['extra']['message_type'] == 'mfa-removed'
+
+    def test_delete(self):
+        user = self.create_user(email='a@example.com', is_superuser=True, password=PASSWORD)
+        # these rows can't go through bulk_create: it doesn't populate
+        # primary keys on Django 1.6 and the URL below needs auth.id
         auth = Authenticator.objects.create(
             type=3,  # u2f
             user=user,
         )
 
+        # has to stay on login_as(): the active-superuser state lives in
+        # the session and the signed superuser cookie, which the
+        # in-memory force_authenticate path never creates
         self.login_as(user=user, superuser=True)
 
-        url = reverse(
-            'sentry-api-0-user-authenticator-details',
-            kwargs={
-                'user_id': user.id,
-                'auth_id': auth.id,
-            }
-        )
-        resp = self.client.delete(url, format='json')
+        url = get_details_url(user.id, auth.id)
+        # removing the only authenticator deletes its row; the security
+        # email is queued in memory and writes nothing
+        with self.assertWriteQueries({'auth_authenticator': 1}):
+            resp = self.client.delete(url, format='json')
         assert resp.status_code == 204, (resp.status_code, resp.content)
 
         assert not Authenticator.objects.filter(
             id=auth.id,
         ).exists()
 
-        self._assert_mfa_removed_email_sent(email_log)
+        self._assert_mfa_removed_email_sent()
 
-    @mock.patch('sentry.utils.email.logger')
-    def test_cannot_delete_without_superuser(self, email_log):
-        user = self.create_user(email='a@example.com', is_superuser=False)
+    def test_cannot_delete_without_superuser(self):
+        user = self.create_user(email='a@example.com', is_superuser=False, password=PASSWORD)
         auth = Authenticator.objects.create(
             type=3,  # u2f
             user=user,
         )
 
-        actor = self.create_user(email='b@example.com', is_superuser=False)
-        self.login_as(user=actor)
+        actor = self.create_user(email='b@example.com', is_superuser=False, password=PASSWORD)
+        self.client = _client_for(actor)
 
-        url = reverse(
-            'sentry-api-0-user-authenticator-details',
-            kwargs={
-                'user_id': user.id,
-                'auth_id': auth.id,
-            }
-        )
+        url = get_details_url(user.id, auth.id)
         resp = self.client.delete(url, format='json')
         assert resp.status_code == 403, (resp.status_code, resp.content)
 
@@ -267,4 +336,4 @@ class UserAuthenticatorDetailsTest(APITestCase):
             id=auth.id,
         ).exists()
 
-        assert email_log.info.call_count == 0
+        assert self.email_log.info.call_count == 0